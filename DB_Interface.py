@@ -1,19 +1,106 @@
+from concurrent.futures import ProcessPoolExecutor
 from hashlib import sha256
 from io import BytesIO
 import math
+import os
+import tempfile
+import time
 import bcrypt
 from fastapi import HTTPException
 from fastapi.responses import JSONResponse, StreamingResponse
 import mysql.connector
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 
-def get_db_connection():
-    return mysql.connector.connect(
-        host="localhost",
-        user="root",
-        password="Akash003!",
-        database="swipe"
-    )
+from progress import Progress
+from shard_router import SHARD_CACHE_SECONDS, router
+
+# users is global reference data kept on the directory shard; lookups are batched in chunks of this size
+USER_LOOKUP_CHUNK = 1000
+
+def get_db_connection(company_id: int):
+    """
+    Connects to the shard holding the given company's data.
+    """
+    return router.connection_for(company_id)
+
+def get_directory_connection():
+    """
+    Connects to the directory shard, which holds the global users table.
+    """
+    return router.directory_connection()
+
+def get_profile_connection(profile_id: int, company_id: int = None):
+    """
+    Connects to the shard holding a profile. Without a company_id every shard is
+    checked in turn and the connection to the one holding the profile is returned.
+    """
+    if company_id is not None:
+        return get_db_connection(company_id)
+    if len(router.shards) == 1:
+        return router.connect(next(iter(router.shards)))
+
+    for shard in router.shards:
+        connection = router.connect(shard)
+        cursor = connection.cursor()
+        cursor.execute("SELECT company_id FROM profiles WHERE profile_id = %s", (profile_id,))
+        row = cursor.fetchone()
+        cursor.close()
+        if row and router.shard_for(row[0]) == shard:
+            return connection
+        connection.close()
+    raise HTTPException(status_code=404, detail="Profile not found.")
+
+def get_user_ids_by_phone(phones: list) -> dict:
+    """
+    Resolves phone numbers to user ids from the directory's users table.
+    :return: Dictionary mapping str(phone_number) to user_id.
+    """
+    phones = list({str(phone) for phone in phones if phone is not None})
+    user_ids = {}
+    if not phones:
+        return user_ids
+    connection = get_directory_connection()
+    cursor = connection.cursor()
+    try:
+        for i in range(0, len(phones), USER_LOOKUP_CHUNK):
+            chunk = phones[i:i + USER_LOOKUP_CHUNK]
+            placeholders = ", ".join(["%s"] * len(chunk))
+            cursor.execute(f"SELECT phone_number, user_id FROM users WHERE phone_number IN ({placeholders})", chunk)
+            user_ids.update({str(phone): user_id for phone, user_id in cursor.fetchall()})
+    finally:
+        cursor.close()
+        connection.close()
+    return user_ids
+
+def get_user_names(user_ids: list, name_like: str = None) -> dict:
+    """
+    Fetches common names from the directory's users table.
+    :param name_like: Optional LIKE pattern; only users whose common_name matches are returned.
+    :return: Dictionary mapping user_id to common_name.
+    """
+    user_ids = list(set(user_ids))
+    names = {}
+    if not user_ids:
+        return names
+    connection = get_directory_connection()
+    cursor = connection.cursor()
+    try:
+        for i in range(0, len(user_ids), USER_LOOKUP_CHUNK):
+            chunk = user_ids[i:i + USER_LOOKUP_CHUNK]
+            placeholders = ", ".join(["%s"] * len(chunk))
+            query = f"SELECT user_id, common_name FROM users WHERE user_id IN ({placeholders})"
+            params = list(chunk)
+            if name_like is not None:
+                query += " AND common_name LIKE %s"
+                params.append(name_like)
+            cursor.execute(query, params)
+            names.update(dict(cursor.fetchall()))
+    finally:
+        cursor.close()
+        connection.close()
+    return names
 
 def hash_password(password: str) -> str:
     """
@@ -21,16 +108,63 @@ def hash_password(password: str) -> str:
     """
     return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt())
 
+def record_changes(cursor, changes: list):
+    """
+    Appends rows to the change_log table using the caller's cursor, so the
+    entries are committed in the same transaction as the write itself.
+    :param changes: List of (entity, entity_id, company_id, operation) tuples.
+    """
+    if not changes:
+        return
+    cursor.executemany("""
+        INSERT INTO change_log (entity, entity_id, company_id, operation)
+        VALUES (%s, %s, %s, %s)
+    """, changes)
+
+def bump_company_stats(cursor, company_id: int, profiles: int = 0, pending: int = 0, users: int = 0):
+    """
+    Adjusts the company_stats counters using the caller's cursor, in the same transaction as the write.
+    A company without a stats row is left alone; get_company_stats rebuilds it on first read.
+    """
+    if not (profiles or pending or users):
+        return
+    cursor.execute("""
+        UPDATE company_stats
+        SET profile_count = profile_count + %s,
+            pending_profile_count = pending_profile_count + %s,
+            user_count = user_count + %s
+        WHERE company_id = %s
+    """, (profiles, pending, users, company_id))
+
+def guard_company_writes(connection, company_id: int):
+    """
+    Refuses the write with a 503 while the company is being moved to another shard.
+    Call it inside the write's transaction: the shared lock it takes on the company's
+    company_write_lock row is held until commit, so a move that freezes the company
+    waits for this write to finish instead of losing it.
+    """
+    cursor = connection.cursor()
+    try:
+        cursor.execute("SELECT frozen FROM company_write_lock WHERE company_id = %s FOR SHARE", (company_id,))
+        row = cursor.fetchall()
+    finally:
+        cursor.close()
+    if row and row[0][0]:
+        raise HTTPException(
+            status_code=503,
+            detail="Company is being moved, please retry shortly.",
+            headers={"Retry-After": str(SHARD_CACHE_SECONDS)},
+        )
+
 def create_account(data: dict):
     """
     Creates a new account in the company_logins table.
     Accepts a dictionary as input.
     """
     connection = None
+    claimed = []
+    committed = False
     try:
-        connection = get_db_connection()
-        cursor = connection.cursor()
-
         email = data["email"]
         password = data["password"]
         company_id = data["company_id"]
@@ -39,6 +173,15 @@ def create_account(data: dict):
         role = data["role"]
         username = data["username"]
 
+        # Emails are unique across all shards; claim it in the index before writing the login
+        claimed, conflicts = router.claim_logins(company_id, [email])
+        if conflicts:
+            raise HTTPException(status_code=400, detail="Email or username already exists.")
+
+        connection = get_db_connection(company_id)
+        cursor = connection.cursor()
+        guard_company_writes(connection, company_id)
+
         # Check if email or username already exists
         cursor.execute("SELECT email, username FROM company_logins WHERE email = %s OR username = %s", (email, username))
         if cursor.fetchone():
@@ -53,7 +196,10 @@ def create_account(data: dict):
         VALUES (%s, %s, %s, %s, %s, %s, %s)
         """
         cursor.execute(insert_query, (email, hashed_password, company_id, company_name, phone_number, role, username))
+        record_changes(cursor, [("user", cursor.lastrowid, company_id, "insert")])
+        bump_company_stats(cursor, company_id, users=1)
         connection.commit()
+        committed = True
 
         return {"message": "Account created successfully."}
 
@@ -61,6 +207,9 @@ def create_account(data: dict):
         raise HTTPException(status_code=500, detail=f"Database error: {e}")
 
     finally:
+        # Give the email back if the login was not written
+        if claimed and not committed:
+            router.release_logins(company_id, claimed)
         if connection and connection.is_connected():
             cursor.close()
             connection.close()
@@ -72,12 +221,17 @@ def login(data: dict):
     """
     connection = None
     try:
-        connection = get_db_connection()
-        cursor = connection.cursor()
-
         email = data["email"]
         password = data["password"]
 
+        # Find the company, and with it the shard, from the global login index
+        company_id = router.company_for_email(email)
+        if company_id is None:
+            raise HTTPException(status_code=404, detail="Email not found.")
+
+        connection = get_db_connection(company_id)
+        cursor = connection.cursor()
+
         # Fetch the hashed password and other user details from the database
         cursor.execute("""
             SELECT password, username, role, company_id, user_id 
@@ -115,7 +269,7 @@ def login(data: dict):
 def get_company_users(company_id: int):
     try:
         # Connect to the MySQL database
-        conn = get_db_connection()
+        conn = get_db_connection(company_id)
         cursor = conn.cursor(dictionary=True)
 
         # Query to get user_id, username, email, and role based on company_id
@@ -154,9 +308,6 @@ def new_company(data: dict):
     """
     connection = None
     try:
-        connection = get_db_connection()
-        cursor = connection.cursor()
-
         # Extract data from the dictionary
         company_name = data["company_name"]
         title = data.get("title", None)
@@ -164,16 +315,23 @@ def new_company(data: dict):
         description = data.get("description", None)
         website_url = data.get("website_url", None)
 
+        # The directory hands out company ids and picks the shard for the new company
+        company_id, shard = router.allocate_company()
+        connection = get_db_connection(company_id)
+        cursor = connection.cursor()
+
         # Insert query
         query = """
-        INSERT INTO companies (company_name, title, company_subname, description, website_url, isAuth)
-        VALUES (%s, %s, %s, %s, %s, %s)
+        INSERT INTO companies (company_id, company_name, title, company_subname, description, website_url, isAuth)
+        VALUES (%s, %s, %s, %s, %s, %s, %s)
         """
-        values = (company_name, title, company_subname, description, website_url, False)
+        values = (company_id, company_name, title, company_subname, description, website_url, False)
         cursor.execute(query, values)
+        cursor.execute("INSERT INTO company_stats (company_id) VALUES (%s)", (company_id,))
+        cursor.execute("INSERT INTO company_write_lock (company_id) VALUES (%s)", (company_id,))
         connection.commit()
 
-        return {"message": "Company details inserted successfully.", "company_id": cursor.lastrowid}
+        return {"message": "Company details inserted successfully.", "company_id": company_id}
 
     except mysql.connector.Error as e:
         raise HTTPException(status_code=500, detail=f"Database error: {e}")
@@ -191,7 +349,8 @@ def update_company_details(company_id: int, data: dict):
     """
     connection = None
     try:
-        connection = get_db_connection()
+        connection = get_db_connection(company_id)
+        guard_company_writes(connection, company_id)
         cursor = connection.cursor()
 
         # Update query
@@ -238,7 +397,7 @@ def get_company_details(company_id: int):
     """
     connection = None
     try:
-        connection = get_db_connection()
+        connection = get_db_connection(company_id)
         cursor = connection.cursor(dictionary=True)  # Return results as dictionaries
 
         # Query to fetch company details
@@ -263,39 +422,54 @@ def update_users(data: dict, company_id: int):
     Creates or updates users' accounts based on the provided data.
     Updates if the user exists, inserts if not.
     Deletes users who are not in the incoming data.
+    Emails that already belong to another company are refused.
     """
     connection = None
+    claimed = []
+    committed = False
     try:
         print("id : ", company_id)
         print("dets : ", data)
 
-        connection = get_db_connection()
+        # Hash before opening the transaction, bcrypt is slow and an open write
+        # transaction holds back the change feed (see change_feed_watermark)
+        hashed_passwords = [
+            bcrypt.hashpw(user.get("username").encode('utf-8'), bcrypt.gensalt()) for user in data["users"]
+        ]
+
+        # Emails are unique across all shards; claim new ones in the index before writing
+        claimed, conflicts = router.claim_logins(company_id, [user.get("email") for user in data["users"]])
+        if conflicts:
+            raise HTTPException(status_code=400, detail=f"Emails already used by another company: {', '.join(conflicts)}")
+
+        connection = get_db_connection(company_id)
         cursor = connection.cursor()
+        guard_company_writes(connection, company_id)
 
         # Fetch company name using company_id
         company_name = get_company_name(company_id)
 
         # Fetch all existing user IDs for the given company_id
         cursor.execute("""
-            SELECT user_id FROM company_logins WHERE company_id = %s
+            SELECT user_id, email FROM company_logins WHERE company_id = %s
         """, (company_id,))
-        existing_user_ids = [row[0] for row in cursor.fetchall()]
+        existing_emails = dict(cursor.fetchall())
+        existing_user_ids = list(existing_emails)
         print("Existing User IDs: ", existing_user_ids)
 
         incoming_user_ids = []
+        changes = []
         # Process incoming users and update/insert them
-        for user in data["users"]:
+        for user, hashed_password in zip(data["users"], hashed_passwords):
             username = user.get("username")
             email = user.get("email")
             role = user.get("role")
-            password = username  # Default password is the username
+            # Default password is the username, hashed above
 
             print("username : ", username)
             print("email : ", email)
             print("role : ", role)
 
-            hashed_password = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt())
-
             # Check if the user already exists in the database
             cursor.execute("""
                 SELECT user_id FROM company_logins WHERE email = %s AND company_id = %s
@@ -306,12 +480,13 @@ def update_users(data: dict, company_id: int):
                 # Update the existing user
                 update_query = """
                 UPDATE company_logins 
-                SET role = %s, username = %s
+                SET role = %s, username = %s, updated_at = CURRENT_TIMESTAMP
                 WHERE email = %s AND company_id = %s
                 """
                 cursor.execute(update_query, (role, username, email, company_id))
                 print("Old user updated..... ")
                 incoming_user_ids.append(existing_user[0])  # Add updated user to incoming list
+                changes.append(("user", existing_user[0], company_id, "update"))
             else:
                 # Insert a new user
                 insert_query = """
@@ -322,6 +497,7 @@ def update_users(data: dict, company_id: int):
                 print("New user added..... ")
                 # Append newly inserted user id to incoming_user_ids
                 incoming_user_ids.append(cursor.lastrowid)
+                changes.append(("user", cursor.lastrowid, company_id, "insert"))
 
         # Find users to delete (those that are in existing_user_ids but not in incoming_user_ids)
         users_to_delete = set(existing_user_ids) - set(incoming_user_ids)
@@ -334,9 +510,20 @@ def update_users(data: dict, company_id: int):
             """
             cursor.execute(delete_query, (user_id, company_id))
             print(f"Deleted user_id: {user_id}")
+            changes.append(("user", user_id, company_id, "delete"))
+
+        # Write tombstones and updates to the change feed
+        record_changes(cursor, changes)
+        added_users = sum(1 for change in changes if change[3] == "insert")
+        bump_company_stats(cursor, company_id, users=added_users - len(users_to_delete))
 
         # Commit the transaction
         connection.commit()
+        committed = True
+
+        # Free the emails of deleted logins. If this fails the entries still point to
+        # this company, so login answers "Email not found" and no other login is affected.
+        router.release_logins(company_id, [existing_emails[user_id] for user_id in users_to_delete])
 
         return {"message": "Accounts processed successfully.", "company_name": company_name}
 
@@ -344,6 +531,9 @@ def update_users(data: dict, company_id: int):
         raise HTTPException(status_code=500, detail=f"Database error: {e}")
 
     finally:
+        # Give back emails claimed for logins that were not written
+        if claimed and not committed:
+            router.release_logins(company_id, claimed)
         if connection and connection.is_connected():
             cursor.close()
             connection.close()
@@ -354,7 +544,7 @@ def get_company_name(company_id: int):
     """
     connection = None
     try:
-        connection = get_db_connection()
+        connection = get_db_connection(company_id)
         cursor = connection.cursor()
 
         # Query to get the company_name based on company_id
@@ -378,20 +568,28 @@ def get_company_name(company_id: int):
             cursor.close()
             connection.close()
 
-def file_upload_new_profile(file_contents: bytes, company_id: int):
+def file_upload_new_profile(file_contents: bytes, company_id: int, progress: Progress = None):
+    progress = progress or Progress()
     try:
         # Read the uploaded file into memory
         df = pd.read_excel(BytesIO(file_contents))  # Read Excel file using pandas
+        progress.total = len(df)
 
         # Explicitly replace NaN with None
         df = df.where(pd.notnull(df), None)
 
         # Database connection
-        conn = get_db_connection()
+        conn = get_db_connection(company_id)
+        guard_company_writes(conn, company_id)
         cursor = conn.cursor()
 
         # Get the company name for the given company_id
         company_name = get_company_name(company_id)
+        changes = []
+
+        # users lives on the directory shard, not on the company's shard
+        user_conn = get_directory_connection()
+        user_cursor = user_conn.cursor()
 
         for index, row in df.iterrows():
             # Convert row to dictionary
@@ -432,14 +630,15 @@ def file_upload_new_profile(file_contents: bytes, company_id: int):
             })
 
             # Fetch user_id using primary_phone (this should be unique in the users table)
-            cursor.execute("SELECT user_id FROM users WHERE phone_number = %s", (primary_phone,))
-            user_result = cursor.fetchone()
+            user_cursor.execute("SELECT user_id FROM users WHERE phone_number = %s", (primary_phone,))
+            user_result = user_cursor.fetchone()
 
             print("User present : ", user_result)
 
             if not user_result:
                 # If no user is found, skip or log the error
                 print(f"User with phone {primary_phone} not found.")
+                progress.skip()
                 continue
 
             user_id = user_result[0]
@@ -469,32 +668,293 @@ def file_upload_new_profile(file_contents: bytes, company_id: int):
                 qualification,
                 designation
             ))
+            changes.append(("profile", cursor.lastrowid, company_id, "insert"))
+            progress.advance()
 
 
             print(query)
 
+        user_cursor.close()
+        user_conn.close()
+
+        record_changes(cursor, changes)
+        bump_company_stats(cursor, company_id, profiles=len(changes), pending=len(changes))
+
         # Commit the changes and close the connection
         conn.commit()
         cursor.close()
         conn.close()
 
+        progress.finish()
         return JSONResponse(content={"message": "File successfully uploaded and data inserted."}, status_code=200)
 
+    except HTTPException as e:
+        progress.fail(str(e.detail))
+        raise
+
     except Exception as e:
         print(f"Exception: {str(e)}")
+        progress.fail(str(e))
         return JSONResponse(content={"message": f"Error: {str(e)}"}, status_code=400)
 
+# Excel column -> profiles column for profile imports
+PROFILE_IMPORT_COLUMNS = {
+    "profile title": "profile_title",
+    "primary_phone": "primary_phone",
+    "secondary_phone": "secondary_phone",
+    "primary_email": "email1",
+    "secondary_email": "email2",
+    "address": "address1",
+    "city": "city",
+    "pincode": "pincode",
+    "country": "country",
+    "designation": "designation",
+    "qualification": "qualification",
+}
+
+IMPORT_INSERT_CHUNK = 1000
+IMPORT_WORKERS = os.cpu_count() or 1
+
+_import_pool = None
+
+def get_import_pool():
+    """
+    Returns the process pool used to parse import workbooks, created on first use.
+    """
+    global _import_pool
+    if _import_pool is None:
+        _import_pool = ProcessPoolExecutor(max_workers=IMPORT_WORKERS)
+    return _import_pool
+
+def clean_import_value(value):
+    """
+    Turns NaN and empty values into None and whole floats (e.g. phones read as 9876543210.0) into ints.
+    """
+    if isinstance(value, float):
+        if math.isnan(value):
+            return None
+        if value.is_integer():
+            return int(value)
+    return value or None
+
+def spool_import_workbook(filename: str, file_contents: bytes) -> str:
+    """
+    Writes an uploaded workbook to a temporary file, so sheet jobs pass its path to
+    the pool instead of pickling the whole workbook once per sheet. The caller removes it.
+    """
+    suffix = os.path.splitext(filename or "")[1] or ".xlsx"
+    with tempfile.NamedTemporaryFile(suffix=suffix, delete=False) as spooled:
+        spooled.write(file_contents)
+    return spooled.name
+
+def list_workbook_sheets(path: str) -> list:
+    """
+    Returns the sheet names of a workbook without parsing the sheets themselves.
+    """
+    with pd.ExcelFile(path) as workbook:
+        return workbook.sheet_names
+
+def parse_profile_sheet(path: str, sheet_name: str):
+    """
+    Reads and cleans one sheet of a profile import workbook. Runs in a worker process;
+    only the requested sheet is parsed, so the sheets of one workbook load in parallel.
+    :return: Rows keyed by profiles column name.
+    """
+    df = pd.read_excel(path, sheet_name=sheet_name)
+    df = df.reindex(columns=list(PROFILE_IMPORT_COLUMNS)).astype(object)
+    return [
+        {column: clean_import_value(value) for column, value in zip(PROFILE_IMPORT_COLUMNS.values(), row)}
+        for row in df.itertuples(index=False, name=None)
+    ]
+
+def file_upload_profiles_parallel(files: list, company_id: int, progress: Progress = None):
+    """
+    Imports profiles from several workbooks, reading every sheet of each.
+    Sheets are parsed across a process pool, one job per sheet, then inserted in file and sheet order.
+    Each sheet is committed on its own, so sheets imported before a failure are kept.
+    :param files: List of (filename, file_contents) tuples.
+    :param company_id: The ID of the company the profiles belong to.
+    :param progress: Optional progress tracker for the /progress stream.
+    :return: Per-sheet results and overall throughput. On failure, an error response
+             listing the sheets already committed and the sheet that failed.
+    """
+    progress = progress or Progress()
+    start = time.perf_counter()
+    spooled = []
+    jobs = []
+    results = []
+    # File and sheet being imported, reported if the import fails part way
+    current = None
+    try:
+        company_name = get_company_name(company_id)
+
+        # Submit one parse job per sheet, keeping the order they were received in
+        pool = get_import_pool()
+        for filename, contents in files:
+            current = {"file": filename, "sheet": None}
+            path = spool_import_workbook(filename, contents)
+            spooled.append(path)
+            jobs.extend(
+                (filename, sheet_name, pool.submit(parse_profile_sheet, path, sheet_name))
+                for sheet_name in list_workbook_sheets(path)
+            )
+        current = None
+
+        conn = get_db_connection(company_id)
+        cursor = conn.cursor()
+        total_rows = 0
+
+        try:
+            cursor.execute("SELECT @@auto_increment_increment")
+            id_step = cursor.fetchone()[0]
+
+            for filename, sheet_name, job in jobs:
+                current = {"file": filename, "sheet": sheet_name}
+                rows = job.result()
+                sheet_start = time.perf_counter()
+                guard_company_writes(conn, company_id)
+                total_rows += len(rows)
+                progress.total = (progress.total or 0) + len(rows)
+
+                # Resolve all phones of the sheet at once instead of one SELECT per row
+                user_ids = get_user_ids_by_phone([row["primary_phone"] for row in rows])
+
+                values = []
+                skipped = []
+                for row in rows:
+                    user_id = user_ids.get(str(row["primary_phone"]))
+                    if user_id is None:
+                        skipped.append(row["primary_phone"])
+                        continue
+                    values.append((
+                        user_id, row["profile_title"], row["primary_phone"], row["secondary_phone"],
+                        row["email1"], row["email2"], row["address1"], company_name, row["city"],
+                        row["pincode"], row["country"], company_id, False, row["qualification"], row["designation"]
+                    ))
+
+                changes = []
+                for i in range(0, len(values), IMPORT_INSERT_CHUNK):
+                    chunk = values[i:i + IMPORT_INSERT_CHUNK]
+                    row_placeholders = ", ".join(["(" + ", ".join(["%s"] * 15) + ")"] * len(chunk))
+                    cursor.execute(f"""
+                    INSERT INTO profiles
+                    (user_id, profile_title, primary_phone, secondary_phone, email1, email2, address1,
+                    company_name, city, pincode, country, company_id, isAuth, qualification, designation)
+                    VALUES {row_placeholders}
+                    """, [value for row in chunk for value in row])
+                    # A multi-row INSERT ... VALUES gets one block of ids with no gaps,
+                    # and lastrowid is the first of them
+                    first_id = cursor.lastrowid
+                    changes.extend(
+                        ("profile", first_id + n * id_step, company_id, "insert") for n in range(cursor.rowcount)
+                    )
+                record_changes(cursor, changes)
+                bump_company_stats(cursor, company_id, profiles=len(values), pending=len(values))
+
+                # Commit each sheet on its own so its change feed entries are not held back by later sheets
+                conn.commit()
+
+                progress.advance(len(values))
+                progress.skip(len(skipped))
+
+                results.append({
+                    "file": filename,
+                    "sheet": sheet_name,
+                    "rows": len(rows),
+                    "inserted": len(values),
+                    "skipped": len(skipped),
+                    "skipped_phones": skipped,
+                    "seconds": round(time.perf_counter() - sheet_start, 3),
+                })
+                current = None
+
+        finally:
+            cursor.close()
+            conn.close()
+
+        progress.finish()
+        elapsed = time.perf_counter() - start
+        return {
+            "message": "Files successfully uploaded and data inserted.",
+            "sheets": results,
+            "rows": total_rows,
+            "seconds": round(elapsed, 3),
+            "rows_per_second": round(total_rows / elapsed, 1) if elapsed else None,
+            "workers": min(IMPORT_WORKERS, len(jobs)),
+        }
+
+    except HTTPException as e:
+        # Keep the status (e.g. 503 with Retry-After during a shard move), but tell the
+        # client which sheets were already committed so a retry can leave them out
+        progress.fail(str(e.detail))
+        return JSONResponse(
+            content={"message": f"Error: {e.detail}", "sheets": results, "failed": current},
+            status_code=e.status_code,
+            headers=e.headers,
+        )
+
+    except Exception as e:
+        print(f"Exception: {str(e)}")
+        progress.fail(str(e))
+        return JSONResponse(content={"message": f"Error: {str(e)}", "sheets": results, "failed": current}, status_code=400)
+
+    finally:
+        # Sheets still queued after a failure are not needed, and their files go with them
+        for filename, sheet_name, job in jobs:
+            job.cancel()
+        for path in spooled:
+            os.remove(path)
+
 def search_emp(company_id: int, search_term: str):
-    connection = get_db_connection()
+    connection = get_db_connection(company_id)
     cursor = connection.cursor(dictionary=True)
 
     try:
-        # Query to search for users by company_id, profile_title, or common_name
+        pattern = f"%{search_term}%"
+
+        if router.shard_for(company_id) == router.directory_shard:
+            # users is on this shard, search it with a JOIN
+            # Query to search for users by company_id, profile_title, or common_name
+            query = """
+            SELECT 
+                p.profile_id,
+                p.profile_title,
+                u.common_name,
+                p.primary_phone,
+                p.email1,
+                p.city,
+                p.country,
+                p.designation,
+                p.qualification
+            FROM profiles p
+            JOIN users u ON u.user_id = p.user_id
+            WHERE p.company_id = %s
+              AND (
+                  p.profile_title LIKE %s  -- Search in profile title
+                  OR u.common_name LIKE %s  -- Search in common name
+                  OR p.designation LIKE %s
+              )
+            """
+            
+            # Execute the query with the company_id and search term
+            cursor.execute(query, (company_id, pattern, pattern, pattern))
+            users = cursor.fetchall()
+
+            return users
+
+        # common_name lives in the directory's users table, so match names there first.
+        # An empty term matches every profile and needs no name lookup.
+        name_matches = []
+        if search_term:
+            cursor.execute("SELECT DISTINCT user_id FROM profiles WHERE company_id = %s", (company_id,))
+            company_user_ids = [row["user_id"] for row in cursor.fetchall()]
+            name_matches = list(get_user_names(company_user_ids, name_like=pattern))
+
         query = """
         SELECT 
             p.profile_id,
+            p.user_id,
             p.profile_title,
-            u.common_name,
             p.primary_phone,
             p.email1,
             p.city,
@@ -502,18 +962,28 @@ def search_emp(company_id: int, search_term: str):
             p.designation,
             p.qualification
         FROM profiles p
-        JOIN users u ON u.user_id = p.user_id
         WHERE p.company_id = %s
-          AND (
-              p.profile_title LIKE %s  -- Search in profile title
-              OR u.common_name LIKE %s  -- Search in common name
-              OR p.designation LIKE %s
-          )
         """
-        
-        # Execute the query with the company_id and search term
-        cursor.execute(query, (company_id, f"%{search_term}%", f"%{search_term}%", f"%{search_term}%"))
-        users = cursor.fetchall()
+        params = [company_id]
+        if search_term:
+            query += " AND (p.profile_title LIKE %s OR p.designation LIKE %s"
+            params.extend([pattern, pattern])
+            if name_matches:
+                query += f" OR p.user_id IN ({', '.join(['%s'] * len(name_matches))})"
+                params.extend(name_matches)
+            query += ")"
+
+        cursor.execute(query, params)
+        profiles = cursor.fetchall()
+
+        # Attach names, dropping profiles whose user no longer exists as the JOIN does
+        names = get_user_names([profile["user_id"] for profile in profiles])
+        users = []
+        for profile in profiles:
+            user_id = profile.pop("user_id")
+            if user_id in names:
+                profile["common_name"] = names[user_id]
+                users.append(profile)
 
         return users
     
@@ -525,15 +995,14 @@ def search_emp(company_id: int, search_term: str):
         cursor.close()
         connection.close()
 
-def get_profile_data(profileID: int):
-    connection = get_db_connection()
+def get_profile_data(profileID: int, company_id: int = None):
+    connection = get_profile_connection(profileID, company_id)
     cursor = connection.cursor(dictionary=True)  # Fetch results as dictionary
 
     try:
         query = """
             SELECT 
-                u.user_id,
-                u.common_name,
+                p.user_id,
                 p.profile_id,
                 p.profile_title,
                 p.primary_phone,
@@ -541,14 +1010,16 @@ def get_profile_data(profileID: int):
                 p.designation,
                 p.qualification
             FROM Profiles p
-            JOIN Users u ON p.user_id = u.user_id
             WHERE p.profile_id = %s;
         """
         cursor.execute(query, (profileID,))
         db_data = cursor.fetchone()  # fetchone() since we expect only one result with a unique profile_id
 
-        if db_data is None:
+        # common_name comes from the directory's users table
+        names = get_user_names([db_data['user_id']]) if db_data else {}
+        if db_data is None or db_data['user_id'] not in names:
             raise HTTPException(status_code=404, detail="Profile not found")
+        db_data['common_name'] = names[db_data['user_id']]
 
         return {
             "user_id": db_data['user_id'],
@@ -585,9 +1056,17 @@ def update_emp(data: dict):
         # Remove 'Emp_profile_id' from data to avoid attempting to update it
         data.pop("Emp_profile_id")
 
-        connection = get_db_connection()
+        connection = get_profile_connection(profile_id, data.pop("company_id", None))
         cursor = connection.cursor()
 
+        # Lock the row and read its current state for the change feed and stats
+        cursor.execute("SELECT company_id, isAuth FROM profiles WHERE profile_id = %s FOR UPDATE", (profile_id,))
+        current = cursor.fetchone()
+        if not current:
+            raise HTTPException(status_code=404, detail="Profile not found.")
+        company_id, was_auth = current
+        guard_company_writes(connection, company_id)
+
         # Mapping the dictionary keys to actual column names in the database
         column_map = {
             "Emp_title": "profile_title",
@@ -620,15 +1099,19 @@ def update_emp(data: dict):
 
         query = f"""
         UPDATE profiles
-        SET {', '.join(update_fields)}
+        SET {', '.join(update_fields)}, updated_at = CURRENT_TIMESTAMP
         WHERE profile_id = %s
         """
         cursor.execute(query, values)
-        connection.commit()
 
         if cursor.rowcount == 0:
             raise HTTPException(status_code=404, detail="Profile not found.")
 
+        record_changes(cursor, [("profile", profile_id, company_id, "update")])
+        # The edit sends an authorized profile back to pending
+        bump_company_stats(cursor, company_id, pending=1 if was_auth else 0)
+        connection.commit()
+
         return {"message": "Profile details updated successfully."}
 
     except mysql.connector.Error as e:
@@ -638,10 +1121,14 @@ def update_emp(data: dict):
         if connection:
             connection.close()
 
-def download_profiles_as_excel(company_id: int):
+# Rows written per to_excel call when exporting, between progress updates
+EXCEL_PROGRESS_CHUNK = 2000
+
+def download_profiles_as_excel(company_id: int, progress: Progress = None):
+    progress = progress or Progress()
     try:
         # Database connection
-        conn = get_db_connection()  # Replace with your database connection logic
+        conn = get_db_connection(company_id)  # Replace with your database connection logic
         cursor = conn.cursor()
 
         # Fetch filtered profiles data
@@ -653,6 +1140,7 @@ def download_profiles_as_excel(company_id: int):
         """
         cursor.execute(query, (company_id,))
         rows = cursor.fetchall()
+        progress.total = len(rows)
 
         # Column names for the Excel file (excluding isAuth)
         columns = [
@@ -664,10 +1152,14 @@ def download_profiles_as_excel(company_id: int):
         # Create a DataFrame from the fetched rows
         df = pd.DataFrame(rows, columns=columns)
 
-        # Create an Excel file in memory
+        # Create an Excel file in memory, in chunks so /progress can follow the write.
+        # The loop runs at least once so an empty export still gets its header row.
         output = BytesIO()
         with pd.ExcelWriter(output, engine="openpyxl") as writer:
-            df.to_excel(writer, index=False, sheet_name="Profiles")
+            for start in range(0, max(len(df), 1), EXCEL_PROGRESS_CHUNK):
+                chunk = df.iloc[start:start + EXCEL_PROGRESS_CHUNK]
+                chunk.to_excel(writer, index=False, sheet_name="Profiles", startrow=start + 1 if start else 0, header=not start)
+                progress.advance(len(chunk))
 
         # Prepare the file for download
         output.seek(0)
@@ -676,11 +1168,14 @@ def download_profiles_as_excel(company_id: int):
             "Content-Type": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
         }
 
-        # Return the Excel file as a streaming response
+        # Return the Excel file as a streaming response. The workbook is complete in
+        # memory at this point, so the operation is reported done before it is sent.
+        progress.finish()
         return StreamingResponse(output, headers=headers)
 
     except Exception as e:
         print(f"Exception: {str(e)}")
+        progress.fail(str(e))
         raise HTTPException(status_code=400, detail=f"Error: {str(e)}")
 
     finally:
@@ -690,6 +1185,137 @@ def download_profiles_as_excel(company_id: int):
         if 'conn' in locals() and conn.is_connected():
             conn.close()
 
+# Columns available in the columnar export, with their Arrow types
+PROFILE_EXPORT_SCHEMA = pa.schema([
+    ("profile_id", pa.int64()),
+    ("user_id", pa.int64()),
+    ("profile_title", pa.string()),
+    ("primary_phone", pa.string()),
+    ("secondary_phone", pa.string()),
+    ("email1", pa.string()),
+    ("email2", pa.string()),
+    ("address1", pa.string()),
+    ("company_name", pa.string()),
+    ("city", pa.string()),
+    ("pincode", pa.string()),
+    ("country", pa.string()),
+    ("designation", pa.string()),
+    ("qualification", pa.string()),
+    ("isAuth", pa.bool_()),
+])
+
+EXPORT_BATCH_SIZE = 5000
+
+class _ChunkSink:
+    """
+    Write-only file object that hands written bytes back in chunks, so the
+    export can be streamed while the writer still sees a growing file.
+    """
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+        self.closed = False
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self) -> bytes:
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+def download_profiles_columnar(company_id: int, file_format: str = "parquet", columns: list = None, is_auth: bool = None, progress: Progress = None):
+    """
+    Streams a company's profiles as Parquet or an Arrow IPC stream, written in record batches.
+    :param company_id: The ID of the company to export.
+    :param file_format: "parquet" or "arrow".
+    :param columns: Columns to export, defaults to all of PROFILE_EXPORT_SCHEMA.
+    :param is_auth: Only export profiles with this isAuth value, None for all.
+    :param progress: Optional progress tracker for the /progress stream.
+    :return: StreamingResponse with the exported file.
+    """
+    progress = progress or Progress()
+    if file_format not in ("parquet", "arrow"):
+        raise HTTPException(status_code=400, detail="Format must be 'parquet' or 'arrow'.")
+
+    columns = columns or PROFILE_EXPORT_SCHEMA.names
+    unknown = [column for column in columns if column not in PROFILE_EXPORT_SCHEMA.names]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown columns: {', '.join(unknown)}")
+    schema = pa.schema([PROFILE_EXPORT_SCHEMA.field(column) for column in columns])
+
+    query = f"SELECT {', '.join(columns)} FROM profiles WHERE company_id = %s"
+    values = [company_id]
+    if is_auth is not None:
+        query += " AND isAuth = %s"
+        values.append(is_auth)
+    query += " ORDER BY profile_id"
+
+    def to_column(values, field):
+        if pa.types.is_string(field.type):
+            values = [None if value is None else str(value) for value in values]
+        elif pa.types.is_boolean(field.type):
+            values = [None if value is None else bool(value) for value in values]
+        return pa.array(values, type=field.type)
+
+    def generate():
+        conn = get_db_connection(company_id)
+        cursor = conn.cursor()  # Unbuffered, rows are pulled from the server batch by batch
+        sink = _ChunkSink()
+        try:
+            cursor.execute(query, values)
+            if file_format == "parquet":
+                writer = pq.ParquetWriter(sink, schema)
+            else:
+                writer = pa.ipc.new_stream(sink, schema)
+
+            while True:
+                rows = cursor.fetchmany(EXPORT_BATCH_SIZE)
+                if not rows:
+                    break
+                arrays = [to_column([row[i] for row in rows], field) for i, field in enumerate(schema)]
+                writer.write_batch(pa.RecordBatch.from_arrays(arrays, schema=schema))
+                progress.advance(len(rows))
+                yield sink.drain()
+
+            writer.close()
+            progress.finish()
+            yield sink.drain()
+
+        except Exception as e:
+            progress.fail(str(e))
+            raise
+
+        finally:
+            # GeneratorExit (client went away) skips the except above
+            if progress.status == "running":
+                progress.fail("Export cancelled before it finished.")
+            try:
+                cursor.close()
+            except mysql.connector.Error:
+                pass  # Rows left unread because the client stopped reading the stream
+            finally:
+                conn.close()
+
+    if file_format == "parquet":
+        filename, media_type = "profiles_data.parquet", "application/vnd.apache.parquet"
+    else:
+        filename, media_type = "profiles_data.arrows", "application/vnd.apache.arrow.stream"
+    headers = {"Content-Disposition": f'attachment; filename="{filename}"'}
+
+    return StreamingResponse(generate(), media_type=media_type, headers=headers)
+
 def update_company_auth_status(company_id: int):
     """
     Updates the isAuth column to True for a specific company in the companies table.
@@ -698,7 +1324,8 @@ def update_company_auth_status(company_id: int):
     """
     connection = None
     try:
-        connection = get_db_connection()
+        connection = get_db_connection(company_id)
+        guard_company_writes(connection, company_id)
         cursor = connection.cursor()
 
         # Update query to set isAuth to True
@@ -730,20 +1357,33 @@ def update_employee_auth_status(company_id: int):
     """
     connection = None
     try:
-        connection = get_db_connection()
+        connection = get_db_connection(company_id)
+        guard_company_writes(connection, company_id)
         cursor = connection.cursor()
 
-        # Update query to set isAuth to True
-        query = """
-        UPDATE profiles
-        SET isAuth = %s
-        WHERE company_id = %s
-        """
-        cursor.execute(query, (True, company_id))
+        # Lock the pending profiles; only those change, so only those go to the change feed
+        cursor.execute("""
+            SELECT profile_id FROM profiles WHERE company_id = %s AND isAuth = 0 FOR UPDATE
+        """, (company_id,))
+        pending_ids = [row[0] for row in cursor.fetchall()]
+
+        for i in range(0, len(pending_ids), BULK_AUTH_CHUNK):
+            chunk = pending_ids[i:i + BULK_AUTH_CHUNK]
+            placeholders = ", ".join(["%s"] * len(chunk))
+            # Update query to set isAuth to True
+            cursor.execute(f"""
+                UPDATE profiles
+                SET isAuth = %s, updated_at = CURRENT_TIMESTAMP
+                WHERE company_id = %s AND profile_id IN ({placeholders})
+            """, (True, company_id, *chunk))
+            record_changes(cursor, [("profile", profile_id, company_id, "update") for profile_id in chunk])
+        bump_company_stats(cursor, company_id, pending=-len(pending_ids))
         connection.commit()
 
-        if cursor.rowcount == 0:
-            raise HTTPException(status_code=404, detail="Company not found.")
+        if not pending_ids:
+            cursor.execute("SELECT 1 FROM companies WHERE company_id = %s", (company_id,))
+            if not cursor.fetchall():
+                raise HTTPException(status_code=404, detail="Company not found.")
 
         return {"message": "Company authentication status updated successfully."}
 
@@ -753,3 +1393,281 @@ def update_employee_auth_status(company_id: int):
     finally:
         if connection:
             connection.close()
+
+BULK_AUTH_CHUNK = 500
+# Filters accepted by bulk_update_employee_auth, mapped to profiles columns
+BULK_AUTH_FILTERS = {"isAuth": "isAuth", "designation": "designation", "city": "city", "country": "country"}
+
+def bulk_update_employee_auth(company_id: int, data: dict):
+    """
+    Approves or rejects a subset of a company's profiles, in chunked transactions.
+    :param company_id: The ID of the company the profiles belong to.
+    :param data: {"action": "approve" | "reject"} with either "profile_ids" (list) or "filter" (dict).
+    :return: Result per profile id (updated, unchanged or not_found) and timing.
+    """
+    start = time.perf_counter()
+    action = data.get("action")
+    if action not in ("approve", "reject"):
+        raise HTTPException(status_code=400, detail="Action must be 'approve' or 'reject'.")
+    is_auth = action == "approve"
+
+    profile_ids = data.get("profile_ids")
+    filters = data.get("filter")
+    if profile_ids is None and filters is None:
+        raise HTTPException(status_code=400, detail="Either profile_ids or filter is required.")
+    if filters is not None:
+        unknown = [key for key in filters if key not in BULK_AUTH_FILTERS]
+        if unknown:
+            raise HTTPException(status_code=400, detail=f"Unknown filter fields: {', '.join(unknown)}")
+
+    connection = None
+    try:
+        connection = get_db_connection(company_id)
+        cursor = connection.cursor()
+
+        if profile_ids is None:
+            # Resolve the filter to ids once, then work through them like an explicit list
+            conditions = ["company_id = %s"]
+            values = [company_id]
+            for key, value in filters.items():
+                conditions.append(f"{BULK_AUTH_FILTERS[key]} = %s")
+                values.append(value)
+            cursor.execute(f"SELECT profile_id FROM profiles WHERE {' AND '.join(conditions)}", values)
+            profile_ids = [row[0] for row in cursor.fetchall()]
+            connection.commit()
+        else:
+            profile_ids = list(dict.fromkeys(int(profile_id) for profile_id in profile_ids))
+
+        results = {}
+        for i in range(0, len(profile_ids), BULK_AUTH_CHUNK):
+            chunk = profile_ids[i:i + BULK_AUTH_CHUNK]
+            placeholders = ", ".join(["%s"] * len(chunk))
+
+            # Lock only this chunk's rows, and only for the length of its transaction
+            guard_company_writes(connection, company_id)
+            cursor.execute(f"""
+                SELECT profile_id, isAuth FROM profiles
+                WHERE company_id = %s AND profile_id IN ({placeholders})
+                FOR UPDATE
+            """, (company_id, *chunk))
+            current = dict(cursor.fetchall())
+            to_update = [profile_id for profile_id in chunk if profile_id in current and bool(current[profile_id]) != is_auth]
+
+            if to_update:
+                update_placeholders = ", ".join(["%s"] * len(to_update))
+                cursor.execute(f"""
+                    UPDATE profiles
+                    SET isAuth = %s, updated_at = CURRENT_TIMESTAMP
+                    WHERE company_id = %s AND profile_id IN ({update_placeholders})
+                """, (is_auth, company_id, *to_update))
+                record_changes(cursor, [("profile", profile_id, company_id, "update") for profile_id in to_update])
+                bump_company_stats(cursor, company_id, pending=-len(to_update) if is_auth else len(to_update))
+            connection.commit()
+
+            updated = set(to_update)
+            for profile_id in chunk:
+                if profile_id not in current:
+                    results[profile_id] = "not_found"
+                else:
+                    results[profile_id] = "updated" if profile_id in updated else "unchanged"
+
+        counts = {status: 0 for status in ("updated", "unchanged", "not_found")}
+        for status in results.values():
+            counts[status] += 1
+
+        return {
+            "message": "Profile authentication status updated.",
+            "action": action,
+            "results": [{"profile_id": profile_id, "status": status} for profile_id, status in results.items()],
+            "counts": counts,
+            "chunks": math.ceil(len(profile_ids) / BULK_AUTH_CHUNK),
+            "seconds": round(time.perf_counter() - start, 3),
+        }
+
+    except mysql.connector.Error as e:
+        raise HTTPException(status_code=500, detail=f"Database error: {e}")
+
+    finally:
+        if connection and connection.is_connected():
+            cursor.close()
+            connection.close()
+
+# Extra margin below the oldest open transaction, covering statements that were
+# stamped with their start time but received their change_id a moment later
+CHANGE_FEED_SAFETY_SECONDS = 2
+
+def change_feed_watermark(cursor):
+    """
+    Returns, using a dictionary cursor, the time before which every change_log entry is committed.
+    change_id is handed out at INSERT time, not at commit, so an open transaction can
+    still commit ids below ones already visible. Its entries are stamped no earlier
+    than its start, so entries older than the oldest open writing transaction are final.
+    Only transactions holding row locks or changes count: every write path takes a lock
+    first (guard_company_writes or FOR UPDATE), while exports and the snapshot of a
+    shard move only read and do not hold the feed back.
+    The watermark is per shard, so a long write transaction delays /changes for every
+    company on its shard until it ends. Write paths keep their transactions short for
+    this reason (chunked bulk updates, one transaction per imported sheet).
+    """
+    cursor.execute("""
+        SELECT COALESCE(MIN(trx_started), NOW()) - INTERVAL %s SECOND AS watermark
+        FROM information_schema.innodb_trx
+        WHERE trx_mysql_thread_id <> CONNECTION_ID()
+          AND (trx_rows_locked > 0 OR trx_rows_modified > 0)
+    """, (CHANGE_FEED_SAFETY_SECONDS,))
+    return cursor.fetchone()["watermark"]
+
+def get_changes(company_id: int, cursor_id: int = 0, since: str = None, limit: int = 500):
+    """
+    Returns profiles and company_logins rows changed after a cursor.
+    :param company_id: The ID of the company to read changes for.
+    :param cursor_id: Last change_id the client has seen (0 for a full sync).
+    :param since: Optional timestamp, used instead of the cursor when given.
+    :param limit: Maximum number of change_log entries to read.
+    :return: Changed rows, tombstones for deleted rows and the next cursor.
+    Entries are read in change_id order and the page stops at the first entry that is
+    not older than the watermark (see change_feed_watermark). Everything returned is
+    then a contiguous run of final entries, so the cursor never skips a change.
+    """
+    connection = None
+    try:
+        connection = get_db_connection(company_id)
+        cursor = connection.cursor(dictionary=True)
+
+        watermark = change_feed_watermark(cursor)
+        if since:
+            cursor.execute("""
+                SELECT change_id, entity, entity_id, operation, changed_at
+                FROM change_log
+                WHERE company_id = %s AND changed_at > %s
+                ORDER BY change_id
+                LIMIT %s
+            """, (company_id, since, limit))
+        else:
+            cursor.execute("""
+                SELECT change_id, entity, entity_id, operation, changed_at
+                FROM change_log
+                WHERE company_id = %s AND change_id > %s
+                ORDER BY change_id
+                LIMIT %s
+            """, (company_id, cursor_id, limit))
+        log_rows = cursor.fetchall()
+
+        # Stop at the first entry that may still have uncommitted ids below it; filtering
+        # it out instead would let the cursor move past it for good. The client picks
+        # the rest up on its next poll.
+        has_more = len(log_rows) == limit
+        for i, entry in enumerate(log_rows):
+            if entry["changed_at"] >= watermark:
+                log_rows = log_rows[:i]
+                has_more = False
+                break
+
+        # Keep only the latest entry per row, a client only needs the final state
+        latest = {}
+        for entry in log_rows:
+            latest.pop((entry["entity"], entry["entity_id"]), None)
+            latest[(entry["entity"], entry["entity_id"])] = entry
+
+        live_ids = {"profile": [], "user": []}
+        for (entity, entity_id), entry in latest.items():
+            if entry["operation"] != "delete":
+                live_ids[entity].append(entity_id)
+
+        # Fetch current state for changed rows with one query per table
+        current = {"profile": {}, "user": {}}
+        if live_ids["profile"]:
+            placeholders = ", ".join(["%s"] * len(live_ids["profile"]))
+            cursor.execute(f"""
+                SELECT profile_id, user_id, profile_title, primary_phone, secondary_phone, email1, email2,
+                       address1, company_name, city, pincode, country, designation, qualification, isAuth, updated_at
+                FROM profiles
+                WHERE company_id = %s AND profile_id IN ({placeholders})
+            """, (company_id, *live_ids["profile"]))
+            current["profile"] = {row["profile_id"]: row for row in cursor.fetchall()}
+        if live_ids["user"]:
+            placeholders = ", ".join(["%s"] * len(live_ids["user"]))
+            cursor.execute(f"""
+                SELECT user_id, username, email, role, updated_at
+                FROM company_logins
+                WHERE company_id = %s AND user_id IN ({placeholders})
+            """, (company_id, *live_ids["user"]))
+            current["user"] = {row["user_id"]: row for row in cursor.fetchall()}
+
+        changes = []
+        for (entity, entity_id), entry in latest.items():
+            data = current[entity].get(entity_id)
+            # A row that is gone by now was deleted after this entry was logged
+            deleted = entry["operation"] == "delete" or data is None
+            changes.append({
+                "change_id": entry["change_id"],
+                "entity": entity,
+                "id": entity_id,
+                "operation": "delete" if deleted else entry["operation"],
+                "changed_at": entry["changed_at"],
+                "data": None if deleted else data,
+            })
+
+        next_cursor = log_rows[-1]["change_id"] if log_rows else cursor_id
+        return {"changes": changes, "next_cursor": next_cursor, "has_more": has_more}
+
+    except mysql.connector.Error as e:
+        raise HTTPException(status_code=500, detail=f"Database error: {e}")
+
+    finally:
+        if connection and connection.is_connected():
+            cursor.close()
+            connection.close()
+
+def refresh_company_stats(cursor, company_id: int):
+    """
+    Rebuilds a company's counters from the profiles and company_logins tables.
+    """
+    cursor.execute("""
+        REPLACE INTO company_stats (company_id, profile_count, pending_profile_count, user_count)
+        SELECT
+            %s,
+            (SELECT COUNT(*) FROM profiles WHERE company_id = %s),
+            (SELECT COUNT(*) FROM profiles WHERE company_id = %s AND isAuth = 0),
+            (SELECT COUNT(*) FROM company_logins WHERE company_id = %s)
+    """, (company_id, company_id, company_id, company_id))
+
+def get_company_stats(company_id: int, refresh: bool = False):
+    """
+    Returns profile, pending-authorization and user counts for a company from company_stats.
+    :param company_id: The ID of the company.
+    :param refresh: Rebuild the counters from the source tables first.
+    :return: A dictionary with the counters.
+    """
+    connection = None
+    try:
+        connection = get_db_connection(company_id)
+        cursor = connection.cursor(dictionary=True)
+
+        query = """
+        SELECT company_id, profile_count, pending_profile_count, user_count, updated_at
+        FROM company_stats
+        WHERE company_id = %s
+        """
+        stats = None
+        if not refresh:
+            cursor.execute(query, (company_id,))
+            stats = cursor.fetchone()
+
+        if not stats:
+            # Missing or refresh requested, count once and keep the result
+            guard_company_writes(connection, company_id)
+            refresh_company_stats(cursor, company_id)
+            connection.commit()
+            cursor.execute(query, (company_id,))
+            stats = cursor.fetchone()
+
+        return stats
+
+    except mysql.connector.Error as e:
+        raise HTTPException(status_code=500, detail=f"Database error: {e}")
+
+    finally:
+        if connection and connection.is_connected():
+            cursor.close()
+            connection.close()
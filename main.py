@@ -1,11 +1,26 @@
+import os
+from typing import List
+
 from fastapi import FastAPI, File, HTTPException, Query, Request, UploadFile
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 
-from DB_Interface import create_account, download_profiles_as_excel, file_upload_new_profile, get_company_details, get_company_users, get_profile_data, login, new_company, search_emp, update_company_auth_status, update_company_details, update_emp, update_employee_auth_status, update_users
+from DB_Interface import bulk_update_employee_auth, create_account, download_profiles_as_excel, download_profiles_columnar, file_upload_new_profile, file_upload_profiles_parallel, get_changes, get_company_details, get_company_stats, get_company_users, get_profile_data, login, new_company, search_emp, update_company_auth_status, update_company_details, update_emp, update_employee_auth_status, update_users
+from progress import progress_events, start_operation
+from query_tracer import QueryTraceMiddleware
+from rate_limiter import RateLimitMiddleware, backend_from_env, limiters
 
 app = FastAPI()
 
+# Set QUERY_BUDGET to make requests fail when they run more queries than that (test mode)
+query_budget = os.environ.get("QUERY_BUDGET")
+app.add_middleware(QueryTraceMiddleware, budget=int(query_budget) if query_budget else None)
+
+# Added before CORS so that 429 responses still carry CORS headers.
+# Set RATE_LIMIT_REDIS_URL to share buckets between workers.
+app.add_middleware(RateLimitMiddleware, backend=backend_from_env())
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],  # Allow all origins
@@ -14,6 +29,15 @@ app.add_middleware(
     allow_headers=["*"],  # Allow all headers
 )
 
+def with_operation_id(result, response: Response, progress):
+    """
+    Returns the operation id in a header so clients that did not pick one can find it.
+    """
+    if isinstance(result, Response):
+        response = result
+    response.headers["X-Operation-Id"] = progress.operation_id
+    return result
+
 @app.post("/create-account")
 async def create_account_endpoint(request: Request):
     try:
@@ -68,17 +92,46 @@ async def update_company(request: Request, data: int = Query(...)):
         user_data = update_users(company_dets, data)
         return user_data
 
+    except HTTPException:
+        # Keep statuses like the 503 sent while the company is being moved
+        raise
+
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"Error processing request: {e}")
 
 @app.post("/upload-file")
-async def upload_file(file: UploadFile = File(...), data: int = Query(...)):
+async def upload_file(response: Response, file: UploadFile = File(...), data: int = Query(...), operation_id: str = Query(None)):
     try:
         # Read the uploaded file into memory
         contents = await file.read()
 
         # Call the function to process the file and insert data
-        return file_upload_new_profile(contents, data)
+        progress = start_operation("import", operation_id)
+        # Run the blocking import in the threadpool so /progress can stream while it works
+        result = await run_in_threadpool(file_upload_new_profile, contents, data, progress)
+        return with_operation_id(result, response, progress)
+
+    except HTTPException:
+        # Keep statuses like the 503 sent while the company is being moved
+        raise
+
+    except Exception as e:
+        return JSONResponse(content={"message": f"Error: {str(e)}"}, status_code=400)
+
+@app.post("/upload-files")
+async def upload_files(response: Response, files: List[UploadFile] = File(...), data: int = Query(...), operation_id: str = Query(None)):
+    """
+    Imports every sheet of every uploaded workbook and reports results per sheet.
+    """
+    try:
+        contents = [(file.filename, await file.read()) for file in files]
+        progress = start_operation("import", operation_id)
+        # The import blocks on the process pool and the database, keep it off the event loop
+        result = await run_in_threadpool(file_upload_profiles_parallel, contents, data, progress)
+        return with_operation_id(result, response, progress)
+
+    except HTTPException:
+        raise
 
     except Exception as e:
         return JSONResponse(content={"message": f"Error: {str(e)}"}, status_code=400)
@@ -92,8 +145,8 @@ def searchFriends(company_id:int, search_query: str):
         raise HTTPException(status_code=500, detail=f"Error searching users: {err}")
     
 @app.get("/profile-data")
-async def profile(data: int = Query(...)):
-    profile_data = get_profile_data(data)
+async def profile(data: int = Query(...), company_id: int = Query(None)):
+    profile_data = get_profile_data(data, company_id)
     return profile_data
 
 @app.post("/update-emp")
@@ -103,8 +156,31 @@ async def updateCompany(request: Request):
     return user_data
 
 @app.get("/download-profiles")
-def download_profiles(company_id: int = Query(...)):
-    return download_profiles_as_excel(company_id)
+def download_profiles(response: Response, company_id: int = Query(...), operation_id: str = Query(None)):
+    progress = start_operation("export", operation_id)
+    return with_operation_id(download_profiles_as_excel(company_id, progress), response, progress)
+
+@app.get("/download-profiles-columnar")
+def download_profiles_columnar_endpoint(response: Response, company_id: int = Query(...), format: str = Query("parquet"), columns: str = Query(None), isAuth: bool = Query(None), operation_id: str = Query(None)):
+    """
+    Exports profiles as Parquet or an Arrow IPC stream. columns is a comma-separated list.
+    """
+    column_list = [column.strip() for column in columns.split(",") if column.strip()] if columns else None
+    progress = start_operation("export", operation_id)
+    try:
+        return with_operation_id(download_profiles_columnar(company_id, format, column_list, isAuth, progress), response, progress)
+    except HTTPException as e:
+        progress.fail(str(e.detail))
+        raise
+
+@app.get("/progress/{operation_id}")
+async def progress_stream(operation_id: str):
+    """
+    Streams rows processed, rows skipped, throughput and ETA of an import or export as Server-Sent Events.
+    Start the operation with the same operation_id query parameter to follow it.
+    """
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    return StreamingResponse(progress_events(operation_id), media_type="text/event-stream", headers=headers)
 
 @app.post("/auth-company")
 async def cards(data: int = Query(...)):
@@ -115,3 +191,35 @@ async def cards(data: int = Query(...)):
 async def cards(data: int = Query(...)):
     user_data = update_employee_auth_status(data)
     return user_data
+
+@app.post("/auth-employees")
+async def auth_employees(request: Request, data: int = Query(...)):
+    """
+    Approves or rejects selected profiles of a company, by profile_ids or by filter.
+    """
+    try:
+        body = await request.json()
+        return bulk_update_employee_auth(data, body)
+    except (TypeError, ValueError) as e:
+        raise HTTPException(status_code=400, detail=f"Invalid request: {e}")
+
+@app.get("/changes")
+def changes(company_id: int = Query(...), cursor: int = Query(0), since: str = Query(None), limit: int = Query(500, le=5000)):
+    """
+    Returns profiles and users changed after the given cursor (or timestamp).
+    """
+    return get_changes(company_id, cursor, since, limit)
+
+@app.get("/company-stats")
+def company_stats(company_id: int = Query(...), refresh: bool = Query(False)):
+    """
+    Returns profile, pending-authorization and user counts without scanning the profiles.
+    """
+    return get_company_stats(company_id, refresh)
+
+@app.get("/rate-limit-stats")
+def rate_limit_stats():
+    """
+    Returns rejection counters and in-flight requests per route.
+    """
+    return [limiter.stats() for limiter in limiters]
@@ -0,0 +1,107 @@
+import asyncio
+import json
+import time
+import uuid
+
+# Finished operations are kept this long so late subscribers still see the result
+FINISHED_TTL_SECONDS = 600
+# How often the SSE stream sends a progress event
+POLL_SECONDS = 0.5
+# How long a subscriber waits for an operation that has not started yet
+WAIT_FOR_START_SECONDS = 30
+
+_operations = {}
+
+
+class Progress:
+    """
+    Counters for one long-running import or export. The loops doing the work
+    only increment integers; rates and ETA are worked out when a snapshot is read.
+    """
+    def __init__(self, operation_id: str = None, kind: str = None):
+        self.operation_id = operation_id
+        self.kind = kind
+        self.status = "running"
+        self.processed = 0
+        self.skipped = 0
+        self.total = None
+        self.error = None
+        self.started = time.monotonic()
+        self.finished = None
+
+    def advance(self, count: int = 1):
+        self.processed += count
+
+    def skip(self, count: int = 1):
+        self.processed += count
+        self.skipped += count
+
+    def finish(self):
+        self.status = "done"
+        self.finished = time.monotonic()
+
+    def fail(self, error: str):
+        self.status = "failed"
+        self.error = error
+        self.finished = time.monotonic()
+
+    def snapshot(self) -> dict:
+        elapsed = (self.finished or time.monotonic()) - self.started
+        rate = self.processed / elapsed if elapsed > 0 else None
+        eta = None
+        if self.status == "running" and rate and self.total is not None:
+            eta = round(max(self.total - self.processed, 0) / rate, 1)
+        return {
+            "operation_id": self.operation_id,
+            "kind": self.kind,
+            "status": self.status,
+            "processed": self.processed,
+            "skipped": self.skipped,
+            "total": self.total,
+            "elapsed_seconds": round(elapsed, 1),
+            "rows_per_second": round(rate, 1) if rate else None,
+            "eta_seconds": eta,
+            "error": self.error,
+        }
+
+
+def start_operation(kind: str, operation_id: str = None) -> Progress:
+    """
+    Registers a new operation so /progress can stream it.
+    :param operation_id: Id chosen by the client, a new one is generated if missing.
+    """
+    now = time.monotonic()
+    for key, progress in list(_operations.items()):
+        if progress.finished and now - progress.finished > FINISHED_TTL_SECONDS:
+            _operations.pop(key, None)
+
+    progress = Progress(operation_id or uuid.uuid4().hex, kind)
+    _operations[progress.operation_id] = progress
+    return progress
+
+
+def get_operation(operation_id: str) -> Progress:
+    return _operations.get(operation_id)
+
+
+async def progress_events(operation_id: str):
+    """
+    Yields Server-Sent Events for an operation until it is done or failed.
+    """
+    waited = 0
+    progress = get_operation(operation_id)
+    while progress is None:
+        if waited >= WAIT_FOR_START_SECONDS:
+            yield f"event: error\ndata: {json.dumps({'message': 'Operation not found.'})}\n\n"
+            return
+        yield f"event: waiting\ndata: {json.dumps({'operation_id': operation_id})}\n\n"
+        await asyncio.sleep(POLL_SECONDS)
+        waited += POLL_SECONDS
+        progress = get_operation(operation_id)
+
+    while True:
+        snapshot = progress.snapshot()
+        yield f"event: progress\ndata: {json.dumps(snapshot)}\n\n"
+        if snapshot["status"] != "running":
+            return
+        await asyncio.sleep(POLL_SECONDS)
@@ -0,0 +1,192 @@
+import contextvars
+import json
+import logging
+import re
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+logger = logging.getLogger("query_tracer")
+
+# Queries slower than this are logged on their own
+SLOW_QUERY_SECONDS = 0.2
+# A statement shape repeated this many times in one request is reported as N+1
+N_PLUS_ONE_THRESHOLD = 5
+
+_current_trace = contextvars.ContextVar("query_trace", default=None)
+
+
+class QueryBudgetExceeded(Exception):
+    """
+    Raised by query_budget when its block ran more queries than the budget.
+    """
+
+
+class QueryTrace:
+    """
+    Statements executed during one request (or one query_budget block).
+    :param budget: Maximum number of statements allowed, None for no limit.
+    """
+    def __init__(self, label: str, budget: int = None):
+        self.label = label
+        self.budget = budget
+        self.queries = []
+        # Set on the first statement over budget. Nothing is raised from execute(), so
+        # the code running the queries still closes its connections and finishes normally.
+        self.exceeded = None
+
+    def record(self, sql: str, seconds: float, rows: int = 1):
+        self.queries.append({"sql": normalize_sql(sql), "seconds": seconds, "rows": rows})
+        if self.budget is not None and self.exceeded is None and len(self.queries) > self.budget:
+            self.exceeded = f"{self.label} went over its budget of {self.budget} queries at: {self.queries[-1]['sql']}"
+
+    def check(self):
+        """
+        Raises QueryBudgetExceeded if the trace went over its budget.
+        """
+        if self.exceeded is not None:
+            raise QueryBudgetExceeded(f"{self.exceeded} ({len(self.queries)} queries in total)")
+
+    def repeated(self, threshold: int = N_PLUS_ONE_THRESHOLD) -> dict:
+        """
+        Returns statement shapes executed at least threshold times.
+        """
+        counts = Counter(query["sql"] for query in self.queries)
+        return {sql: count for sql, count in counts.items() if count >= threshold}
+
+    def summary(self) -> dict:
+        return {
+            "label": self.label,
+            "query_count": len(self.queries),
+            "total_seconds": round(sum(query["seconds"] for query in self.queries), 4),
+            "n_plus_one": self.repeated(),
+        }
+
+
+def normalize_sql(sql: str) -> str:
+    """
+    Reduces a statement to its shape so the same query with different values compares equal.
+    """
+    sql = re.sub(r"--[^\n]*", " ", sql)
+    sql = re.sub(r"'(?:[^'\\]|\\.)*'", "?", sql)
+    sql = re.sub(r"\b\d+\b", "?", sql)
+    sql = sql.replace("%s", "?")
+    sql = re.sub(r"\(\s*\?(?:\s*,\s*\?)*\s*\)", "(...)", sql)
+    return re.sub(r"\s+", " ", sql).strip()
+
+
+def _record(sql: str, seconds: float, rows: int = 1):
+    if seconds >= SLOW_QUERY_SECONDS:
+        logger.warning("Slow query (%.3fs): %s", seconds, normalize_sql(sql))
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.record(sql, seconds, rows)
+
+
+class TracedCursor:
+    """
+    Wraps a DB-API cursor and records every execute() in the current trace.
+    """
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def execute(self, operation, params=None, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return self._cursor.execute(operation, params, *args, **kwargs)
+        finally:
+            _record(operation, time.perf_counter() - start)
+
+    def executemany(self, operation, seq_params, *args, **kwargs):
+        seq_params = list(seq_params)
+        start = time.perf_counter()
+        try:
+            return self._cursor.executemany(operation, seq_params, *args, **kwargs)
+        finally:
+            _record(operation, time.perf_counter() - start, len(seq_params))
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+
+class TracedConnection:
+    """
+    Wraps a DB-API connection so every cursor it opens is traced.
+    """
+    def __init__(self, connection):
+        self._connection = connection
+
+    def cursor(self, *args, **kwargs):
+        return TracedCursor(self._connection.cursor(*args, **kwargs))
+
+    def __getattr__(self, name):
+        return getattr(self._connection, name)
+
+
+@contextmanager
+def query_budget(max_queries: int, label: str = "block"):
+    """
+    Test helper: raises QueryBudgetExceeded after the block if it ran more than max_queries statements.
+    """
+    trace = QueryTrace(label, budget=max_queries)
+    token = _current_trace.set(trace)
+    try:
+        yield trace
+    finally:
+        _current_trace.reset(token)
+    trace.check()
+
+
+class QueryTraceMiddleware:
+    """
+    ASGI middleware that traces the statements of each request and logs
+    repeated same-shape statements as likely N+1 queries.
+    :param budget: When set, requests exceeding this many statements fail with a 500
+                   once they have finished (test mode). The response is held back
+                   until then, so streaming responses arrive in one piece.
+    """
+    def __init__(self, app, budget: int = None):
+        self.app = app
+        self.budget = budget
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        trace = QueryTrace(f"{scope['method']} {scope['path']}", budget=self.budget)
+        token = _current_trace.set(trace)
+        held = []
+
+        async def hold(message):
+            held.append(message)
+
+        try:
+            await self.app(scope, receive, send if self.budget is None else hold)
+        finally:
+            _current_trace.reset(token)
+            for sql, count in trace.repeated().items():
+                logger.warning("Possible N+1 in %s: %d x %s", trace.label, count, sql)
+            logger.debug("Query trace: %s", trace.summary())
+
+        if trace.exceeded is not None:
+            logger.error("Query budget exceeded: %s", trace.exceeded)
+            await self.fail(send, trace.exceeded)
+            return
+        for message in held:
+            await send(message)
+
+    async def fail(self, send, message: str):
+        body = json.dumps({"message": f"Query budget exceeded: {message}"}).encode("utf-8")
+        await send({
+            "type": "http.response.start",
+            "status": 500,
+            "headers": [
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(body)).encode("latin-1")),
+            ],
+        })
+        await send({"type": "http.response.body", "body": body})
@@ -0,0 +1,246 @@
+import asyncio
+import inspect
+import json
+import logging
+import math
+import os
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from urllib.parse import parse_qs
+
+from starlette.routing import Match
+
+logger = logging.getLogger("rate_limiter")
+
+
+class RouteLimit:
+    """
+    Limits for one route.
+    :param rate: Tokens added per second to each tenant's bucket.
+    :param burst: Bucket size, i.e. how many requests a tenant can make at once.
+    :param max_concurrent: Requests allowed in flight across all tenants (None for no cap).
+    """
+    def __init__(self, rate: float, burst: int, max_concurrent: int = None):
+        self.rate = rate
+        self.burst = burst
+        self.max_concurrent = max_concurrent
+
+
+# Routes doing bcrypt, Excel parsing or Excel export get tighter limits
+ROUTE_LIMITS = {
+    "/login": RouteLimit(rate=2, burst=10, max_concurrent=4),
+    "/create-account": RouteLimit(rate=1, burst=5, max_concurrent=2),
+    "/update-user": RouteLimit(rate=0.5, burst=3, max_concurrent=2),
+    "/upload-file": RouteLimit(rate=0.2, burst=2, max_concurrent=2),
+    "/upload-files": RouteLimit(rate=0.1, burst=1, max_concurrent=1),
+    "/download-profiles": RouteLimit(rate=0.5, burst=3, max_concurrent=2),
+    "/download-profiles-columnar": RouteLimit(rate=0.5, burst=3, max_concurrent=2),
+}
+DEFAULT_LIMIT = RouteLimit(rate=20, burst=40)
+
+# Routes where the "data" query parameter is not a company_id
+NON_TENANT_DATA_ROUTES = {"/profile-data"}
+
+# Requests that match no route share one key, so unknown paths cannot grow the tables
+UNMATCHED_ROUTE = "<unmatched>"
+# Upper bound on buckets kept in process; the least recently used are dropped first
+MAX_BUCKETS = 100000
+# How often (in take() calls) idle buckets are swept out
+SWEEP_EVERY = 1000
+# A backend call slower than this lets the request through, as does a backend error
+BACKEND_TIMEOUT_SECONDS = 0.05
+
+
+class InMemoryBackend:
+    """
+    Token buckets kept in this process. A bucket that has been idle long enough
+    to refill completely is dropped, as it is the same as a new one.
+    """
+    def __init__(self, max_buckets: int = MAX_BUCKETS):
+        self.max_buckets = max_buckets
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+        self._calls = 0
+
+    def take(self, key: str, rate: float, burst: int) -> float:
+        """
+        Takes one token from the bucket for key.
+        :return: 0 if the request is allowed, otherwise seconds until a token is available.
+        """
+        now = time.monotonic()
+        with self._lock:
+            tokens, last, _ = self._buckets.pop(key, (burst, now, 0))
+            tokens = min(burst, tokens + (now - last) * rate)
+            wait = 0 if tokens >= 1 else (1 - tokens) / rate
+            if not wait:
+                tokens -= 1
+            # Kept in least-recently-used order, with the time at which the bucket is full again
+            self._buckets[key] = (tokens, now, now + (burst - tokens) / rate)
+
+            self._calls += 1
+            if self._calls % SWEEP_EVERY == 0:
+                for idle_key in [k for k, bucket in self._buckets.items() if bucket[2] <= now]:
+                    del self._buckets[idle_key]
+            while len(self._buckets) > self.max_buckets:
+                self._buckets.popitem(last=False)
+            return wait
+
+    def __len__(self):
+        return len(self._buckets)
+
+
+class RedisBackend:
+    """
+    Token buckets shared by every worker through Redis. Each bucket is a hash that
+    expires once it would be full again. take() is a coroutine so the round trip does
+    not block the event loop; any client with the redis.asyncio eval() API works, so a
+    local Redis or an in-process stand-in such as fakeredis.aioredis can be used.
+    """
+    SCRIPT = """
+    local rate = tonumber(ARGV[1])
+    local burst = tonumber(ARGV[2])
+    local clock = redis.call('TIME')
+    local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+    local state = redis.call('HMGET', KEYS[1], 'tokens', 'last')
+    local tokens = tonumber(state[1]) or burst
+    local last = tonumber(state[2]) or now
+    tokens = math.min(burst, tokens + math.max(0, now - last) * rate)
+    local wait = 0
+    if tokens >= 1 then
+        tokens = tokens - 1
+    else
+        wait = (1 - tokens) / rate
+    end
+    redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'last', tostring(now))
+    redis.call('PEXPIRE', KEYS[1], math.ceil((burst - tokens) / rate * 1000) + 1000)
+    return tostring(wait)
+    """
+
+    def __init__(self, client, prefix: str = "ratelimit:"):
+        self.client = client
+        self.prefix = prefix
+
+    async def take(self, key: str, rate: float, burst: int) -> float:
+        return float(await self.client.eval(self.SCRIPT, 1, self.prefix + key, rate, burst))
+
+
+def backend_from_env():
+    """
+    Picks the bucket backend: Redis when RATE_LIMIT_REDIS_URL is set, else in-process.
+    """
+    url = os.environ.get("RATE_LIMIT_REDIS_URL")
+    if not url:
+        return InMemoryBackend()
+    try:
+        import redis.asyncio
+    except ImportError:
+        raise RuntimeError("RATE_LIMIT_REDIS_URL is set but the redis package is not installed.")
+    return RedisBackend(redis.asyncio.Redis.from_url(url))
+
+
+class RateLimitMiddleware:
+    """
+    ASGI middleware that sheds load with a 429 and Retry-After when a tenant
+    runs out of tokens for a route or an expensive route is at its concurrency cap.
+    The backend's take() may be a plain function or a coroutine. If it fails or is
+    slower than BACKEND_TIMEOUT_SECONDS the request is let through and counted.
+    """
+    def __init__(self, app, backend=None, route_limits: dict = None, default_limit: RouteLimit = DEFAULT_LIMIT):
+        self.app = app
+        self.backend = backend if backend is not None else InMemoryBackend()
+        self.route_limits = ROUTE_LIMITS if route_limits is None else route_limits
+        self.default_limit = default_limit
+        self.in_flight = defaultdict(int)
+        self.rejections = defaultdict(int)
+        self.backend_errors = 0
+        limiters.append(self)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] == "OPTIONS":
+            await self.app(scope, receive, send)
+            return
+
+        route = self.route_template(scope)
+        limit = self.route_limits.get(route, self.default_limit)
+
+        wait = await self.take(f"{self.tenant_key(scope, route)}:{route}", limit)
+        if wait > 0:
+            self.rejections[("rate", route)] += 1
+            await self.reject(send, wait, "Rate limit exceeded.")
+            return
+
+        if limit.max_concurrent is not None and self.in_flight[route] >= limit.max_concurrent:
+            self.rejections[("concurrency", route)] += 1
+            await self.reject(send, 1, "Server busy, please retry.")
+            return
+
+        self.in_flight[route] += 1
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.in_flight[route] -= 1
+
+    async def take(self, key: str, limit: RouteLimit) -> float:
+        """
+        Takes a token from the backend, failing open when the backend is down or slow.
+        """
+        try:
+            wait = self.backend.take(key, limit.rate, limit.burst)
+            if inspect.isawaitable(wait):
+                wait = await asyncio.wait_for(wait, BACKEND_TIMEOUT_SECONDS)
+            return wait
+        except Exception as e:
+            self.backend_errors += 1
+            logger.warning("Rate limit backend failed, letting the request through: %r", e)
+            return 0
+
+    def route_template(self, scope) -> str:
+        """
+        Returns the path template of the matching route (e.g. "/progress/{operation_id}").
+        """
+        app = scope.get("app")
+        for route in getattr(getattr(app, "router", None), "routes", []):
+            match, _ = route.matches(scope)
+            if match != Match.NONE:
+                return getattr(route, "path", UNMATCHED_ROUTE)
+        return UNMATCHED_ROUTE
+
+    def tenant_key(self, scope, route: str) -> str:
+        """
+        Keys requests by company_id when the route carries one, else by client address.
+        """
+        params = parse_qs(scope.get("query_string", b"").decode("latin-1"))
+        if "company_id" in params:
+            return f"company:{params['company_id'][0]}"
+        if "data" in params and route not in NON_TENANT_DATA_ROUTES:
+            return f"company:{params['data'][0]}"
+        client = scope.get("client")
+        return f"client:{client[0] if client else 'unknown'}"
+
+    async def reject(self, send, retry_after: float, message: str):
+        body = json.dumps({"message": message}).encode("utf-8")
+        await send({
+            "type": "http.response.start",
+            "status": 429,
+            "headers": [
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(body)).encode("latin-1")),
+                (b"retry-after", str(math.ceil(retry_after)).encode("latin-1")),
+            ],
+        })
+        await send({"type": "http.response.body", "body": body})
+
+    def stats(self) -> dict:
+        return {
+            "rejections": [
+                {"reason": reason, "route": route, "count": count}
+                for (reason, route), count in self.rejections.items()
+            ],
+            "in_flight": {route: count for route, count in self.in_flight.items() if count},
+            "backend_errors": self.backend_errors,
+        }
+
+
+# Middleware instances register here so endpoints can read their counters
+limiters = []
@@ -0,0 +1,20 @@
+-- Change feed support for /changes.
+-- Every write to profiles or company_logins appends a row to change_log in the
+-- same transaction, so clients can sync by asking for changes after a cursor.
+
+ALTER TABLE profiles
+    ADD COLUMN updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP;
+
+ALTER TABLE company_logins
+    ADD COLUMN updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP;
+
+CREATE TABLE IF NOT EXISTS change_log (
+    change_id BIGINT AUTO_INCREMENT PRIMARY KEY,
+    entity VARCHAR(32) NOT NULL,          -- 'profile' or 'user'
+    entity_id INT NOT NULL,               -- profile_id or user_id
+    company_id INT NOT NULL,
+    operation VARCHAR(16) NOT NULL,       -- 'insert', 'update' or 'delete'
+    changed_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    INDEX idx_change_log_company (company_id, change_id),
+    INDEX idx_change_log_changed_at (company_id, changed_at)
+);
@@ -0,0 +1,19 @@
+-- Per-company counters behind /company-stats, created on every shard.
+-- Write paths adjust these in the same transaction as the write itself.
+
+CREATE TABLE IF NOT EXISTS company_stats (
+    company_id INT PRIMARY KEY,
+    profile_count INT NOT NULL DEFAULT 0,
+    pending_profile_count INT NOT NULL DEFAULT 0,   -- profiles with isAuth = 0
+    user_count INT NOT NULL DEFAULT 0,              -- rows in company_logins
+    updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
+);
+
+-- Backfill existing companies
+INSERT IGNORE INTO company_stats (company_id, profile_count, pending_profile_count, user_count)
+SELECT
+    c.company_id,
+    (SELECT COUNT(*) FROM profiles p WHERE p.company_id = c.company_id),
+    (SELECT COUNT(*) FROM profiles p WHERE p.company_id = c.company_id AND p.isAuth = 0),
+    (SELECT COUNT(*) FROM company_logins l WHERE l.company_id = c.company_id)
+FROM companies c;
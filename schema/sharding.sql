@@ -0,0 +1,37 @@
+-- Tenant sharding directory, created in the directory database (the original `swipe` schema).
+-- Every shard database has the same company tables as `swipe` (companies, company_logins,
+-- profiles, change_log, company_stats). `users` is global and is only read from the directory.
+
+CREATE TABLE IF NOT EXISTS shard_map (
+    company_id INT AUTO_INCREMENT PRIMARY KEY,   -- also allocates ids for new companies
+    shard VARCHAR(64) NOT NULL,
+    state VARCHAR(16) NOT NULL DEFAULT 'active', -- 'active', 'moving' or 'frozen'
+    updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
+);
+
+-- Global lookup used by login, which only knows the email
+CREATE TABLE IF NOT EXISTS login_index (
+    email VARCHAR(255) PRIMARY KEY,
+    company_id INT NOT NULL
+);
+
+-- Backfill for an existing single-database deployment
+INSERT IGNORE INTO shard_map (company_id, shard) SELECT company_id, 'default' FROM companies;
+INSERT IGNORE INTO login_index (email, company_id) SELECT email, company_id FROM company_logins;
+
+-- Created on every shard database. Writes read their company's row FOR SHARE in
+-- their own transaction; a move sets frozen, which waits for those writes to commit
+-- and refuses later ones. The old shard keeps its frozen row after a move.
+CREATE TABLE IF NOT EXISTS company_write_lock (
+    company_id INT PRIMARY KEY,
+    frozen BOOLEAN NOT NULL DEFAULT FALSE
+);
+INSERT IGNORE INTO company_write_lock (company_id) SELECT company_id FROM companies;
+
+-- Rows keep their ids when a company moves between shards, and the move aborts
+-- instead of overwriting when an id is already taken on the target. Give each shard
+-- database its own id range when it is created, e.g. on the second shard:
+--   ALTER TABLE profiles AUTO_INCREMENT = 100000001;
+--   ALTER TABLE company_logins AUTO_INCREMENT = 100000001;
+-- (auto_increment_offset is a server-wide setting, so it cannot separate shards that
+-- share a server.) change_log entries are renumbered on the target and need no range.
@@ -0,0 +1,393 @@
+import argparse
+import json
+import os
+import threading
+import time
+
+from fastapi import HTTPException
+import mysql.connector
+
+from query_tracer import TracedConnection
+
+# Connection settings per shard. Override with a JSON object in SHARD_CONFIG, e.g.
+# {"default": {...}, "shard2": {"host": "localhost", "user": "root", "password": "...", "database": "swipe_2"}}
+SHARDS = json.loads(os.environ["SHARD_CONFIG"]) if os.environ.get("SHARD_CONFIG") else {
+    "default": {
+        "host": "localhost",
+        "user": "root",
+        "password": "Akash003!",
+        "database": "swipe",
+    },
+}
+# Shard holding shard_map and login_index
+DIRECTORY_SHARD = os.environ.get("DIRECTORY_SHARD", "default")
+# Shard that new companies are placed on
+NEW_COMPANY_SHARD = os.environ.get("NEW_COMPANY_SHARD", "default")
+# How long a company's shard assignment is cached; a move waits this long after the
+# switch before deleting the old copy, and refused writes are told to retry after it
+SHARD_CACHE_SECONDS = 5
+MOVE_BATCH_SIZE = 1000
+# How long freezing a company may wait for its in-flight writes to commit
+FREEZE_WAIT_SECONDS = 600
+
+# Tables holding a company's rows, copied in this order when moving a company
+COMPANY_TABLES = ["companies", "company_logins", "profiles", "change_log", "company_stats"]
+# Primary key of each table that appears in change_log
+ENTITY_TABLES = {"profile": ("profiles", "profile_id"), "user": ("company_logins", "user_id")}
+
+
+class ShardRouter:
+    """
+    Resolves company_id to the shard database holding that company's rows.
+    """
+    def __init__(self, shards: dict, directory_shard: str, new_company_shard: str):
+        self.shards = shards
+        self.directory_shard = directory_shard
+        self.new_company_shard = new_company_shard
+        self._cache = {}
+        self._lock = threading.Lock()
+
+    def connect(self, shard: str):
+        if shard not in self.shards:
+            raise HTTPException(status_code=500, detail=f"Unknown shard: {shard}")
+        return TracedConnection(mysql.connector.connect(**self.shards[shard]))
+
+    def directory_connection(self):
+        return self.connect(self.directory_shard)
+
+    def lookup(self, company_id: int):
+        """
+        Returns (shard, state) for a company. Companies missing from shard_map live on the directory shard.
+        """
+        now = time.monotonic()
+        with self._lock:
+            cached = self._cache.get(company_id)
+        if cached and now - cached[2] < SHARD_CACHE_SECONDS:
+            return cached[0], cached[1]
+
+        connection = self.directory_connection()
+        try:
+            cursor = connection.cursor()
+            cursor.execute("SELECT shard, state FROM shard_map WHERE company_id = %s", (company_id,))
+            row = cursor.fetchone()
+            cursor.close()
+        finally:
+            connection.close()
+
+        shard, state = row if row else (self.directory_shard, "active")
+        with self._lock:
+            self._cache[company_id] = (shard, state, now)
+        return shard, state
+
+    def shard_for(self, company_id: int) -> str:
+        # Reads keep going to the source during a move; writes are held back on the
+        # shard itself by company_write_lock (see DB_Interface.guard_company_writes)
+        return self.lookup(company_id)[0]
+
+    def connection_for(self, company_id: int):
+        return self.connect(self.shard_for(company_id))
+
+    def invalidate(self, company_id: int):
+        with self._lock:
+            self._cache.pop(company_id, None)
+
+    def allocate_company(self) -> tuple:
+        """
+        Allocates a new company_id in the directory and places it on the new-company shard.
+        :return: (company_id, shard)
+        """
+        connection = self.directory_connection()
+        try:
+            cursor = connection.cursor()
+            cursor.execute("INSERT INTO shard_map (shard) VALUES (%s)", (self.new_company_shard,))
+            connection.commit()
+            company_id = cursor.lastrowid
+            cursor.close()
+        finally:
+            connection.close()
+        return company_id, self.new_company_shard
+
+    def set_shard(self, company_id: int, shard: str, state: str):
+        connection = self.directory_connection()
+        try:
+            cursor = connection.cursor()
+            cursor.execute("""
+                INSERT INTO shard_map (company_id, shard, state) VALUES (%s, %s, %s)
+                ON DUPLICATE KEY UPDATE shard = VALUES(shard), state = VALUES(state)
+            """, (company_id, shard, state))
+            connection.commit()
+            cursor.close()
+        finally:
+            connection.close()
+        self.invalidate(company_id)
+
+    def claim_move(self, company_id: int, shard: str) -> bool:
+        """
+        Marks an active company on the given shard as moving, in one conditional UPDATE
+        so two movers cannot both start.
+        :return: False if the company is elsewhere or already being moved.
+        """
+        connection = self.directory_connection()
+        try:
+            cursor = connection.cursor()
+            # Companies missing from shard_map live on the directory shard
+            cursor.execute("INSERT IGNORE INTO shard_map (company_id, shard) VALUES (%s, %s)",
+                           (company_id, self.directory_shard))
+            cursor.execute("""
+                UPDATE shard_map SET state = 'moving' WHERE company_id = %s AND shard = %s AND state = 'active'
+            """, (company_id, shard))
+            claimed = cursor.rowcount == 1
+            connection.commit()
+            cursor.close()
+        finally:
+            connection.close()
+        self.invalidate(company_id)
+        return claimed
+
+    def company_for_email(self, email: str):
+        """
+        Looks up which company a login email belongs to, None if unknown.
+        """
+        connection = self.directory_connection()
+        try:
+            cursor = connection.cursor()
+            cursor.execute("SELECT company_id FROM login_index WHERE email = %s", (email,))
+            row = cursor.fetchone()
+            cursor.close()
+        finally:
+            connection.close()
+        return row[0] if row else None
+
+    def claim_logins(self, company_id: int, emails: list) -> tuple:
+        """
+        Adds login emails to the global index for a company without taking over
+        emails that already belong to another company.
+        :return: (claimed, conflicts) - emails newly indexed for this company, and
+                 emails owned by another company. Release claimed if the write fails.
+        """
+        emails = list(dict.fromkeys(email for email in emails if email))
+        if not emails:
+            return [], []
+        placeholders = ", ".join(["%s"] * len(emails))
+        connection = self.directory_connection()
+        try:
+            cursor = connection.cursor()
+            cursor.execute(f"SELECT email FROM login_index WHERE email IN ({placeholders})", emails)
+            indexed = {row[0] for row in cursor.fetchall()}
+            cursor.executemany(
+                "INSERT IGNORE INTO login_index (email, company_id) VALUES (%s, %s)",
+                [(email, company_id) for email in emails if email not in indexed],
+            )
+            cursor.execute(f"SELECT email, company_id FROM login_index WHERE email IN ({placeholders})", emails)
+            owners = dict(cursor.fetchall())
+            connection.commit()
+            cursor.close()
+        finally:
+            connection.close()
+        claimed = [email for email in emails if email not in indexed and owners.get(email) == company_id]
+        conflicts = [email for email in emails if owners.get(email) != company_id]
+        return claimed, conflicts
+
+    def release_logins(self, company_id: int, emails: list):
+        """
+        Removes login emails from the global index, only where they belong to the company.
+        """
+        if not emails:
+            return
+        connection = self.directory_connection()
+        try:
+            cursor = connection.cursor()
+            cursor.executemany("DELETE FROM login_index WHERE email = %s AND company_id = %s",
+                               [(email, company_id) for email in emails])
+            connection.commit()
+            cursor.close()
+        finally:
+            connection.close()
+
+
+router = ShardRouter(SHARDS, DIRECTORY_SHARD, NEW_COMPANY_SHARD)
+
+
+def _copy_rows(source_cursor, target_cursor, table: str, where: str, params: tuple,
+               columns: list = None, order_by: str = None):
+    """
+    Copies matching rows from source to target in batches with a plain INSERT, so a
+    row whose key is already taken on the target raises IntegrityError instead of
+    overwriting another company's row.
+    :param columns: Columns to copy, all of them by default. Leave out the key to have
+                    the target assign new ids.
+    :return: Number of rows copied.
+    """
+    source_cursor.execute(
+        f"SELECT {', '.join(columns) if columns else '*'} FROM {table} WHERE {where}"
+        + (f" ORDER BY {order_by}" if order_by else ""),
+        params,
+    )
+    columns = source_cursor.column_names
+    insert = f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join(['%s'] * len(columns))})"
+    copied = 0
+    while True:
+        rows = source_cursor.fetchmany(MOVE_BATCH_SIZE)
+        if not rows:
+            return copied
+        target_cursor.executemany(insert, rows)
+        copied += len(rows)
+
+
+def _recopy_rows(source_cursor, target_cursor, table: str, where: str, params: tuple) -> int:
+    """
+    Replaces the target's copy of matching rows with the source's current rows.
+    The where clause must be limited to the moving company.
+    """
+    target_cursor.execute(f"DELETE FROM {table} WHERE {where}", params)
+    return _copy_rows(source_cursor, target_cursor, table, where, params)
+
+
+def _copy_change_log(source_cursor, target_cursor, company_id: int, where: str, params: tuple) -> int:
+    """
+    Copies change_log entries in order under new ids. The target's counter is first
+    raised past the source's ids, so no change is hidden behind a client's cursor; a
+    client syncing across the move is sent the company's current rows again.
+    """
+    source_cursor.execute("SELECT COALESCE(MAX(change_id), 0) FROM change_log WHERE company_id = %s", (company_id,))
+    next_id = int(source_cursor.fetchone()[0]) + 1
+    # InnoDB ignores a value below the table's current counter, and the ALTER commits
+    target_cursor.execute(f"ALTER TABLE change_log AUTO_INCREMENT = {next_id}")
+    return _copy_rows(source_cursor, target_cursor, "change_log", f"company_id = %s AND {where}", (company_id, *params),
+                      columns=["entity", "entity_id", "company_id", "operation", "changed_at"], order_by="change_id")
+
+
+def move_company(company_id: int, target_shard: str, keep_source: bool = False):
+    """
+    Moves one company to another shard while it stays online.
+    Rows are bulk copied from one snapshot while writes continue on the source. The
+    company is then frozen, which waits for writes already in flight, and everything
+    changed since the snapshot is replayed from change_log before the switch.
+    Rows keep their ids, except change_log entries which are renumbered on the target.
+    If an id is already taken on the target the move is aborted and rolled back.
+    """
+    router.invalidate(company_id)
+    source_shard = router.shard_for(company_id)
+    if source_shard == target_shard:
+        return {"message": "Company is already on this shard.", "shard": target_shard}
+
+    source = router.connect(source_shard)
+    target = router.connect(target_shard)
+    moved = False
+    started = False
+    frozen = False
+    try:
+        source_cursor = source.cursor(buffered=True)
+        target_cursor = target.cursor(buffered=True)
+
+        # Rows left behind by an earlier move would make the abort cleanup below unsafe
+        for table in COMPANY_TABLES:
+            target_cursor.execute(f"SELECT 1 FROM {table} WHERE company_id = %s LIMIT 1", (company_id,))
+            if target_cursor.fetchone():
+                raise HTTPException(
+                    status_code=409,
+                    detail=f"Shard {target_shard} already has {table} rows for company {company_id}.",
+                )
+
+        if not router.claim_move(company_id, source_shard):
+            raise HTTPException(status_code=409, detail=f"Company is already being moved ({router.lookup(company_id)[1]}).")
+        started = True
+
+        # A write the snapshot below cannot see is either open now or starts later, so
+        # its change_log entries are stamped no earlier than start_time
+        source_cursor.execute("""
+            SELECT COALESCE(MIN(trx_started), NOW()) FROM information_schema.innodb_trx
+            WHERE trx_mysql_thread_id <> CONNECTION_ID()
+        """)
+        start_time = source_cursor.fetchone()[0]
+        source.commit()
+        source.start_transaction(consistent_snapshot=True)
+
+        copied = {}
+        for table in COMPANY_TABLES:
+            if table == "change_log":
+                copied[table] = _copy_change_log(source_cursor, target_cursor, company_id,
+                                                 "changed_at < %s", (start_time,))
+            else:
+                copied[table] = _copy_rows(source_cursor, target_cursor, table, "company_id = %s", (company_id,))
+            target.commit()
+        source.commit()
+
+        # Freezing waits for every write that already passed guard_company_writes to
+        # commit, and later writes are refused, so the source stops changing here
+        router.set_shard(company_id, source_shard, "frozen")
+        source_cursor.execute("SET SESSION innodb_lock_wait_timeout = %s", (FREEZE_WAIT_SECONDS,))
+        source_cursor.execute("""
+            INSERT INTO company_write_lock (company_id, frozen) VALUES (%s, TRUE)
+            ON DUPLICATE KEY UPDATE frozen = TRUE
+        """, (company_id,))
+        source.commit()
+        frozen = True
+
+        source_cursor.execute("""
+            SELECT DISTINCT entity, entity_id FROM change_log WHERE company_id = %s AND changed_at >= %s
+        """, (company_id, start_time))
+        replayed = 0
+        for entity, entity_id in source_cursor.fetchall():
+            table, key = ENTITY_TABLES[entity]
+            _recopy_rows(source_cursor, target_cursor, table, f"{key} = %s AND company_id = %s", (entity_id, company_id))
+            replayed += 1
+        _recopy_rows(source_cursor, target_cursor, "companies", "company_id = %s", (company_id,))
+        _recopy_rows(source_cursor, target_cursor, "company_stats", "company_id = %s", (company_id,))
+        target.commit()
+        _copy_change_log(source_cursor, target_cursor, company_id, "changed_at >= %s", (start_time,))
+        target_cursor.execute("""
+            INSERT INTO company_write_lock (company_id, frozen) VALUES (%s, FALSE)
+            ON DUPLICATE KEY UPDATE frozen = FALSE
+        """, (company_id,))
+        target.commit()
+
+        router.set_shard(company_id, target_shard, "active")
+        moved = True
+
+        if not keep_source:
+            # Workers read from the source until their cached assignment expires. The
+            # source's write lock stays frozen, so none of them can write there again.
+            time.sleep(SHARD_CACHE_SECONDS)
+            for table in reversed(COMPANY_TABLES):
+                source_cursor.execute(f"DELETE FROM {table} WHERE company_id = %s", (company_id,))
+            source.commit()
+
+        return {
+            "message": "Company moved successfully.",
+            "company_id": company_id,
+            "source": source_shard,
+            "target": target_shard,
+            "copied": copied,
+            "replayed": replayed,
+        }
+
+    except Exception:
+        # Leave the company readable and writable on its original shard, and drop
+        # the partial copy so a later move starts from an empty target
+        if started and not moved:
+            target.rollback()
+            source.rollback()
+            try:
+                for table in reversed(COMPANY_TABLES + ["company_write_lock"]):
+                    target_cursor.execute(f"DELETE FROM {table} WHERE company_id = %s", (company_id,))
+                target.commit()
+                if frozen:
+                    source_cursor.execute("UPDATE company_write_lock SET frozen = FALSE WHERE company_id = %s", (company_id,))
+                    source.commit()
+            finally:
+                router.set_shard(company_id, source_shard, "active")
+        raise
+
+    finally:
+        source.close()
+        target.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Move a company to another shard.")
+    parser.add_argument("company_id", type=int)
+    parser.add_argument("target_shard")
+    parser.add_argument("--keep-source", action="store_true", help="Do not delete the company's rows from the old shard")
+    args = parser.parse_args()
+    print(json.dumps(move_company(args.company_id, args.target_shard, args.keep_source), indent=2))